@@ -20,7 +20,7 @@ setuptools.setup(
     author='Dave Shawley',
     author_email='daves@aweber.com',
     license='BSD',
-    extras_require={'tornado': ['tornado>3,<5']},
+    extras_require={'orjson': ['orjson'], 'tornado': ['tornado>3,<5']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
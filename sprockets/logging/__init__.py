@@ -3,6 +3,9 @@ Make good log output easier.
 
 - :class:`ContextFilter` adds fixed properties to a log record
 - :class:`JSONRequestFormatter` formats log records as JSON output
+- :class:`JSONBytesHandler` writes JSON formatted records as bytes
+- :func:`install_async_json_logging` moves a handler onto a background
+    thread
 - :method:`tornado_log_function` is for use as the
     :class`tornado.web.Application.log_function` in conjunction with
     :class:`JSONRequestFormatter` to output log lines as JSON.
@@ -11,17 +14,23 @@ Make good log output easier.
 from __future__ import absolute_import
 
 from logging import config
+import collections
 import json
+import linecache
 import logging
+import math
 import os
 import sys
-import traceback
+import time
 
 try:
-    from tornado import escape, log
-except ImportError:  # pragma no cover
-    escape = None
-    log = None
+    import orjson
+except ImportError:
+    orjson = None
+
+# Imported from tornado the first time tornado_log_function is called
+escape = None
+log = None
 
 version_info = (1, 3, 2)
 __version__ = '.'.join(str(v) for v in version_info)
@@ -36,13 +45,60 @@ WARN = logging.WARN
 WARNING = logging.WARNING
 ERROR = logging.ERROR
 
+# Access log level indexed by the "hundreds" digit of the status code
+_ACCESS_LOG_LEVELS = (INFO, INFO, INFO, INFO, WARNING, ERROR)
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=str,
+                                 allow_nan=False)
+
+
+def _replace_non_finite(obj):
+    """Replace NaN and infinite floats with None as orjson does."""
+    if isinstance(obj, float):
+        return None if math.isinf(obj) or math.isnan(obj) else obj
+    if isinstance(obj, dict):
+        return {key: _replace_non_finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_replace_non_finite(value) for value in obj]
+    return obj
+
+
+def _json_encode(obj):
+    try:
+        return _json_encoder.encode(obj)
+    except ValueError:  # NaN or infinity, which are not valid JSON
+        return _json_encoder.encode(_replace_non_finite(obj))
+
+
+if orjson is not None:  # pragma no cover
+    def _dumps_bytes(obj):
+        try:
+            # Datetimes are passed through to default=str so that they
+            # are written the same way as by the json fallback
+            return orjson.dumps(obj, default=str,
+                                option=(orjson.OPT_NON_STR_KEYS |
+                                        orjson.OPT_PASSTHROUGH_DATETIME))
+        except orjson.JSONEncodeError:
+            # orjson rejects values that json accepts, such as integers
+            # beyond 64 bits and strings containing lone surrogates
+            return _json_encode(obj).encode('utf-8')
+
+    def _dumps(obj):
+        return _dumps_bytes(obj).decode('utf-8')
+else:
+    _dumps = _json_encode
+
+    def _dumps_bytes(obj):
+        return _dumps(obj).encode('utf-8')
+
 
 class ContextFilter(logging.Filter):
     """
     Ensures that properties exist on a LogRecord.
 
-    :param list|None properties: optional list of properties that
-        will be added to LogRecord instances if they are missing
+    :param list|dict|None properties: optional list of properties that
+        will be added to LogRecord instances if they are missing.  If a
+        dict is passed, its values are used instead of :data:`None`.
 
     This filter implementation will ensure that a set of properties
     exists on every log record which means that you can always refer
@@ -54,12 +110,25 @@ class ContextFilter(logging.Filter):
 
     def __init__(self, name='', properties=None):
         logging.Filter.__init__(self, name)
-        self.properties = list(properties) if properties else []
+        self.properties = properties
+
+    @property
+    def properties(self):
+        """Tuple of the property names that are ensured to exist."""
+        return tuple(name for name, _ in self._defaults)
+
+    @properties.setter
+    def properties(self, properties):
+        if isinstance(properties, dict):
+            defaults = collections.OrderedDict(properties)
+        else:
+            defaults = collections.OrderedDict.fromkeys(properties or ())
+        self._defaults = tuple(defaults.items())
 
     def filter(self, record):
-        for property_name in self.properties:
-            if not hasattr(record, property_name):
-                setattr(record, property_name, None)
+        setdefault = record.__dict__.setdefault
+        for property_name, default in self._defaults:
+            setdefault(property_name, default)
         return True
 
 
@@ -67,8 +136,20 @@ class JSONRequestFormatter(logging.Formatter):
     """Instead of spitting out a "human readable" log line, this outputs
     the log data as JSON.
 
+    :keyword bool include_source: set this to :data:`False` to omit the
+        source line ``text`` from traceback frames and skip reading
+        source files when an exception is logged
+
     """
 
+    default_time_format = '%Y-%m-%d %H:%M:%S'
+    default_msec_format = '%s,%03d'
+
+    def __init__(self, *args, **kwargs):
+        self.include_source = kwargs.pop('include_source', True)
+        logging.Formatter.__init__(self, *args, **kwargs)
+        self._last_time = (None, None, None)
+
     def extract_exc_record(self, typ, val, tb):
         """Create a JSON representation of the traceback given the records
         exc_info
@@ -83,13 +164,44 @@ class JSONRequestFormatter(logging.Formatter):
         exc_record = {'type': typ.__name__,
                       'message': str(val),
                       'stack': []}
-        for file_name, line_no, func_name, txt in traceback.extract_tb(tb):
+        # Walk the traceback directly instead of using extract_tb, which
+        # stats every source file via linecache.checkcache
+        while tb is not None:
+            frame, line_no = tb.tb_frame, tb.tb_lineno
+            file_name = frame.f_code.co_filename
+            txt = None
+            if self.include_source:
+                txt = linecache.getline(file_name, line_no,
+                                        frame.f_globals).strip()
             exc_record['stack'].append({'file': file_name,
                                         'line': str(line_no),
-                                        'func': func_name,
+                                        'func': frame.f_code.co_name,
                                         'text': txt})
+            tb = tb.tb_next
         return exc_record
 
+    def formatTime(self, record, datefmt=None):
+        """Return the creation time of the record as a string
+
+        :param record logging.LogRecord: The record to format
+        :param str|None datefmt: optional :func:`time.strftime` format
+        :rtype: str
+
+        This produces the same output as
+        :meth:`logging.Formatter.formatTime` but only calls
+        :func:`time.strftime` when the second changes.
+
+        """
+        second = int(record.created)
+        last_second, last_datefmt, formatted = self._last_time
+        if second != last_second or datefmt != last_datefmt:
+            formatted = time.strftime(datefmt or self.default_time_format,
+                                      self.converter(record.created))
+            self._last_time = (second, datefmt, formatted)
+        if datefmt or not self.default_msec_format:
+            return formatted
+        return self.default_msec_format % (formatted, record.msecs)
+
     def format(self, record):
         """Return the log data as JSON
 
@@ -97,29 +209,135 @@ class JSONRequestFormatter(logging.Formatter):
         :rtype: str
 
         """
-        if hasattr(record, 'exc_info'):
-            try:
-                traceback = self.extract_exc_record(*record.exc_info)
-            except:
-                traceback = None
-
-        output = {'name': record.name,
-                  'module': record.module,
-                  'message': record.msg % record.args,
-                  'level': logging.getLevelName(record.levelno),
-                  'line_number': record.lineno,
-                  'process': record.processName,
-                  'timestamp': self.formatTime(record),
-                  'thread': record.threadName,
-                  'file': record.filename,
-                  'request': record.args,
-                  'traceback': traceback}
-        for key, value in list(output.items()):
-            if not value:
-                del output[key]
-        if 'message' in output:
-            output.pop('request', None)
-        return json.dumps(output)
+        return _dumps(self._build_output(record))
+
+    def format_bytes(self, record):
+        """Return the log data as UTF-8 encoded JSON
+
+        :param record logging.LogRecord: The record to format
+        :rtype: bytes
+
+        This is used by :class:`JSONBytesHandler` to avoid decoding the
+        encoder output only to have the stream encode it again.
+
+        """
+        return _dumps_bytes(self._build_output(record))
+
+    def _build_output(self, record):
+        exc_record = None
+        if record.exc_info and record.exc_info[0] is not None:
+            if self.include_source and (
+                    type(self).extract_exc_record ==
+                    JSONRequestFormatter.extract_exc_record):
+                # Cache the extracted traceback on the record in the same
+                # manner as logging.Formatter caches ``exc_text``.  Only
+                # the default form is cached so that formatters with other
+                # settings or overrides never share it.
+                exc_record = getattr(record, '_cached_tb', None)
+                if exc_record is None:
+                    exc_record = self.extract_exc_record(*record.exc_info)
+                    record._cached_tb = exc_record
+            else:
+                exc_record = self.extract_exc_record(*record.exc_info)
+
+        message = record.msg % record.args if record.args else record.msg
+        return {key: value for key, value in (
+            ('name', record.name),
+            ('module', record.module),
+            ('message', message),
+            ('level', record.levelname),
+            ('line_number', record.lineno),
+            ('process', record.processName),
+            ('timestamp', self.formatTime(record)),
+            ('thread', record.threadName),
+            ('file', record.filename),
+            ('request', None if message else record.args),
+            ('traceback', exc_record)) if value}
+
+
+class JSONBytesHandler(logging.StreamHandler):
+    """Write :class:`JSONRequestFormatter` output to a stream as bytes.
+
+    :param stream: optional stream to write to, defaults to
+        :data:`sys.stderr`
+
+    Each record is written as a line of UTF-8 encoded JSON to the binary
+    buffer underlying `stream` (or to `stream` itself if it does not have
+    one).  When the formatter uses :meth:`JSONRequestFormatter.format`,
+    the encoded bytes are written directly instead of being decoded into
+    a string and encoded again by the stream.  Formatters that override
+    ``format`` are called as usual and their output is encoded.
+
+    """
+
+    terminator = '\n'
+
+    def emit(self, record):
+        try:
+            formatter_class = type(self.formatter)
+            if (getattr(formatter_class, 'format', None) ==
+                    JSONRequestFormatter.format):
+                data = self.formatter.format_bytes(record)
+            else:
+                data = self.format(record).encode('utf-8')
+            stream = getattr(self.stream, 'buffer', None)
+            if stream is None:
+                stream = self.stream
+            else:
+                # Write out any text pending in the wrapper first so that
+                # output stays in order
+                self.stream.flush()
+            stream.write(data + self.terminator.encode('utf-8'))
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+def install_async_json_logging(handler):
+    """Format and emit log records for `handler` on a background thread.
+
+    :param logging.Handler handler: the handler to move off of the
+        logging thread, typically one using :class:`JSONRequestFormatter`
+    :returns: the started listener -- call its ``stop`` method at
+        shutdown to detach the queue from the root logger and emit any
+        records that are still queued
+    :rtype: logging.handlers.QueueListener
+
+    A queue handler is attached to the root logger so that logging calls
+    only enqueue the record.  Filtering, JSON encoding, and traceback
+    extraction for `handler` then happen in the listener's thread.
+    Requires Python 3.5 or newer, :exc:`RuntimeError` is raised on
+    older versions.
+
+    """
+    if sys.version_info < (3, 5):  # pragma no cover
+        raise RuntimeError('install_async_json_logging requires Python 3.5')
+    from logging.handlers import QueueHandler, QueueListener
+    import queue
+
+    class RecordQueueHandler(QueueHandler):
+        # The stock prepare() formats the record on the calling thread
+        # and discards ``args`` and ``exc_info``, which
+        # JSONRequestFormatter needs.
+        def prepare(self, record):
+            return record
+
+    class RootQueueListener(QueueListener):
+        def stop(self):
+            root_logger.removeHandler(queue_handler)
+            QueueListener.stop(self)
+
+    try:
+        log_queue = queue.SimpleQueue()
+    except AttributeError:  # pragma no cover
+        log_queue = queue.Queue()
+    root_logger = logging.getLogger()
+    queue_handler = RecordQueueHandler(log_queue)
+    listener = RootQueueListener(log_queue, handler,
+                                 respect_handler_level=True)
+    root_logger.addHandler(queue_handler)
+    listener.start()
+    return listener
 
 
 def tornado_log_function(handler):
@@ -134,26 +352,46 @@ def tornado_log_function(handler):
     :type handler: :py:class:`tornado.web.RequestHandler`
 
     """
+    global escape, log
+    if log is None:
+        from tornado import escape, log
+
     status_code = handler.get_status()
-    if status_code < 400:
-        log_method = log.access_log.info
-    elif status_code < 500:
-        log_method = log.access_log.warning
-    else:
-        log_method = log.access_log.error
+    log_level = _ACCESS_LOG_LEVELS[min(status_code // 100, 5)]
+    if not log.access_log.isEnabledFor(log_level):
+        return
+    request = handler.request
+    headers = _headers_snapshot(request.headers)
     correlation_id = (getattr(handler, 'correlation_id', None) or
-                      handler.request.headers.get('Correlation-ID', None))
-    log_method('', {'correlation_id': correlation_id,
-                    'duration': 1000.0 * handler.request.request_time(),
-                    'headers': dict(handler.request.headers),
-                    'method': handler.request.method,
-                    'path': handler.request.path,
-                    'protocol': handler.request.protocol,
-                    'query_args': escape.recursive_unicode(
-                        handler.request.query_arguments),
-                    'remote_ip': handler.request.remote_ip,
-                    'status_code': status_code,
-                    'environment': os.environ.get('ENVIRONMENT')})
+                      headers.get('Correlation-Id', None))
+    log.access_log.log(
+        log_level, '',
+        {'correlation_id': correlation_id,
+         'duration': 1000.0 * request.request_time(),
+         'headers': headers,
+         'method': request.method,
+         'path': request.path,
+         'protocol': request.protocol,
+         'query_args': escape.recursive_unicode(request.query_arguments),
+         'remote_ip': request.remote_ip,
+         'status_code': status_code,
+         'environment': os.environ.get('ENVIRONMENT')})
+
+
+def _headers_snapshot(headers):
+    """Copy a :class:`tornado.httputil.HTTPHeaders` instance into a dict.
+
+    This produces the same result as ``dict(headers)`` -- repeated headers
+    are joined with commas -- without the per-key ``__getitem__`` calls.
+
+    """
+    snapshot = {}
+    for name, value in headers.get_all():
+        if name in snapshot:
+            snapshot[name] += ',' + value
+        else:
+            snapshot[name] = value
+    return snapshot
 
 
 def currentframe():
@@ -1,6 +1,11 @@
+import datetime
+import decimal
+import io
 import json
 import logging
+import logging.handlers
 import os
+import sys
 import unittest
 import uuid
 
@@ -79,6 +84,23 @@ class TornadoLogFunctionTests(TornadoLoggingTestMixin,
         self.fetch('/?runtime_error=something%20bad%20happened')
         self.assertEqual(self.access_record.levelno, logging.ERROR)
 
+    def test_that_payload_is_not_built_when_level_is_disabled(self):
+        snapshots = []
+
+        def headers_snapshot(headers):
+            snapshots.append(headers)
+            return {}
+
+        original = sprockets.logging._headers_snapshot
+        self.addCleanup(setattr, sprockets.logging, '_headers_snapshot',
+                        original)
+        sprockets.logging._headers_snapshot = headers_snapshot
+        self.addCleanup(self.access_log.setLevel, self.access_log.level)
+        self.access_log.setLevel(logging.CRITICAL)
+        self.fetch('/?runtime_error=something%20bad%20happened')
+        self.assertIsNone(self.access_record)
+        self.assertEqual(snapshots, [])
+
     def test_that_log_includes_correlation_id(self):
         self.fetch('/?runtime_error=something%20bad%20happened')
         self.assertIn('correlation_id', self.access_record.args)
@@ -91,6 +113,12 @@ class TornadoLogFunctionTests(TornadoLoggingTestMixin,
         self.fetch('/?runtime_error=something%20bad%20happened')
         self.assertIn('headers', self.access_record.args)
 
+    def test_that_log_includes_header_values(self):
+        self.fetch('/?runtime_error=something%20bad%20happened',
+                   headers={'X-Custom': 'value'})
+        self.assertEqual(self.access_record.args['headers']['X-Custom'],
+                         'value')
+
     def test_that_log_includes_method(self):
         self.fetch('/?runtime_error=something%20bad%20happened')
         self.assertEqual(self.access_record.args['method'], 'GET')
@@ -155,6 +183,24 @@ class JSONFormatterTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
         self.assertIsNotNone(entry.get('traceback'))
         self.assertNotEqual(entry['traceback'], [])
 
+    def test_that_traceback_includes_source_text(self):
+        self.fetch('/?runtime_error=foo')
+        entry = self.get_log_line('tornado.application')
+        frame = entry['traceback']['stack'][-1]
+        self.assertTrue(frame['file'].endswith('tests.py'))
+        self.assertEqual(frame['func'], 'get')
+        self.assertEqual(
+            frame['text'],
+            "raise RuntimeError(self.get_query_argument('runtime_error'))")
+
+    def test_that_traceback_is_cached_on_record(self):
+        self.fetch('/?runtime_error=foo')
+        matches = [(record, line) for record, line in self.recorder.emitted
+                   if record.name == 'tornado.application']
+        self.assertEqual(len(matches), 1)
+        record, line = matches[0]
+        self.assertEqual(record._cached_tb, json.loads(line)['traceback'])
+
     def test_that_successes_do_not_have_traceback(self):
         self.fetch('/')
         for record, line in self.recorder.emitted:
@@ -162,6 +208,226 @@ class JSONFormatterTests(TornadoLoggingTestMixin, testing.AsyncHTTPTestCase):
             self.assertNotIn('traceback', entry)
 
 
+class JSONRequestFormatterTests(unittest.TestCase):
+
+    def setUp(self):
+        super(JSONRequestFormatterTests, self).setUp()
+        self.formatter = sprockets.logging.JSONRequestFormatter()
+        self.record = logging.LogRecord('name', logging.INFO, __file__, 1,
+                                        'message', (), None)
+
+    def test_that_format_time_matches_standard_formatter(self):
+        expected = logging.Formatter().formatTime(self.record)
+        self.assertEqual(self.formatter.formatTime(self.record), expected)
+        self.assertEqual(self.formatter.formatTime(self.record), expected)
+
+    def test_that_format_time_honors_datefmt(self):
+        self.formatter.formatTime(self.record)
+        self.assertEqual(self.formatter.formatTime(self.record, '%Y'),
+                         logging.Formatter().formatTime(self.record, '%Y'))
+
+    def test_that_format_time_tracks_milliseconds(self):
+        self.formatter.formatTime(self.record)
+        self.record.created += 0.5
+        self.record.msecs = (self.record.msecs + 500) % 1000
+        self.assertEqual(self.formatter.formatTime(self.record),
+                         logging.Formatter().formatTime(self.record))
+
+    def test_that_message_without_args_is_not_interpolated(self):
+        self.record.msg = '100% done'
+        entry = json.loads(self.formatter.format(self.record))
+        self.assertEqual(entry['message'], '100% done')
+
+    def test_that_values_outside_orjson_limits_are_encoded(self):
+        self.record.msg = ''
+        self.record.args = {'id': 2 ** 70, 'text': u'\ud800'}
+        entry = json.loads(self.formatter.format(self.record))
+        self.assertEqual(entry['request'],
+                         {'id': 2 ** 70, 'text': u'\ud800'})
+
+    def test_that_encoding_does_not_depend_on_orjson(self):
+        self.record.msg = ''
+        self.record.args = {'when': datetime.datetime(2020, 1, 2, 3, 4, 5),
+                            'ratio': float('nan'),
+                            'values': [float('inf'), 1.5]}
+        entry = json.loads(self.formatter.format(self.record))
+        self.assertEqual(entry['request'],
+                         {'when': '2020-01-02 03:04:05',
+                          'ratio': None,
+                          'values': [None, 1.5]})
+
+    def test_that_unserializable_values_are_stringified(self):
+        self.record.msg = ''
+        self.record.args = {'amount': decimal.Decimal('1.50')}
+        entry = json.loads(self.formatter.format(self.record))
+        self.assertEqual(entry['request'], {'amount': '1.50'})
+
+    def test_that_source_settings_do_not_share_cached_traceback(self):
+        without_source = sprockets.logging.JSONRequestFormatter(
+            include_source=False)
+        try:
+            raise RuntimeError('failure')
+        except RuntimeError:
+            self.record.exc_info = sys.exc_info()
+        for formatters in ((without_source, self.formatter),
+                           (self.formatter, without_source)):
+            self.record.__dict__.pop('_cached_tb', None)
+            lines = [json.loads(formatter.format(self.record))
+                     for formatter in formatters]
+            by_formatter = dict(zip(formatters, lines))
+            self.assertIsNone(by_formatter[without_source]
+                              ['traceback']['stack'][-1]['text'])
+            self.assertEqual(by_formatter[self.formatter]
+                             ['traceback']['stack'][-1]['text'],
+                             "raise RuntimeError('failure')")
+
+    def test_that_overridden_extraction_does_not_share_cached_traceback(self):
+        class Formatter(sprockets.logging.JSONRequestFormatter):
+            def extract_exc_record(self, typ, val, tb):
+                return {'type': typ.__name__}
+
+        try:
+            raise RuntimeError('failure')
+        except RuntimeError:
+            self.record.exc_info = sys.exc_info()
+        self.formatter.format(self.record)
+        entry = json.loads(Formatter().format(self.record))
+        self.assertEqual(entry['traceback'], {'type': 'RuntimeError'})
+
+    def test_that_exc_record_extra_is_not_used_as_traceback(self):
+        try:
+            raise RuntimeError('failure')
+        except RuntimeError:
+            self.record.exc_info = sys.exc_info()
+        self.record.exc_record = {'type': 'Spoofed'}
+        entry = json.loads(self.formatter.format(self.record))
+        self.assertEqual(entry['traceback']['type'], 'RuntimeError')
+
+    def test_that_missing_source_lines_are_empty(self):
+        code = compile("raise RuntimeError('failure')", '<generated>', 'exec')
+        try:
+            exec(code)
+        except RuntimeError:
+            exc_record = self.formatter.extract_exc_record(*sys.exc_info())
+        self.assertEqual(exc_record['stack'][-1]['file'], '<generated>')
+        self.assertEqual(exc_record['stack'][-1]['text'], '')
+
+    def test_that_source_lines_can_be_omitted(self):
+        formatter = sprockets.logging.JSONRequestFormatter(
+            include_source=False)
+        try:
+            raise RuntimeError('failure')
+        except RuntimeError:
+            exc_record = formatter.extract_exc_record(*sys.exc_info())
+        self.assertEqual(exc_record['type'], 'RuntimeError')
+        self.assertIsNone(exc_record['stack'][-1]['text'])
+
+
+class JSONBytesHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        super(JSONBytesHandlerTests, self).setUp()
+        self.stream = io.BytesIO()
+        self.handler = sprockets.logging.JSONBytesHandler(self.stream)
+        self.record = logging.LogRecord('name', logging.INFO, __file__, 1,
+                                        'message %s', ('one',), None)
+
+    def test_that_json_is_written_as_bytes(self):
+        self.handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        self.handler.handle(self.record)
+        self.handler.handle(self.record)
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0].decode('utf-8'))['message'],
+                         'message one')
+
+    def test_that_subclass_format_is_used(self):
+
+        class CustomFormatter(sprockets.logging.JSONRequestFormatter):
+            def format(self, record):
+                return 'CUSTOM'
+
+        self.handler.setFormatter(CustomFormatter())
+        self.handler.handle(self.record)
+        self.assertEqual(self.stream.getvalue(), b'CUSTOM\n')
+
+    def test_that_terminator_is_used(self):
+        self.handler.setFormatter(sprockets.logging.JSONRequestFormatter())
+        self.handler.terminator = '\r\n'
+        self.handler.handle(self.record)
+        self.assertTrue(self.stream.getvalue().endswith(b'}\r\n'))
+
+    def test_that_pending_text_is_written_first(self):
+        stream = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        handler = sprockets.logging.JSONBytesHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        stream.write(u'text\n')
+        handler.handle(self.record)
+        self.assertEqual(stream.buffer.getvalue(), b'text\nmessage one\n')
+
+    def test_that_other_formatters_are_encoded(self):
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handler.handle(self.record)
+        self.assertEqual(self.stream.getvalue(), b'message one\n')
+
+
+@unittest.skipIf(sys.version_info >= (3, 5),
+                 'install_async_json_logging is supported')
+class AsyncJSONLoggingUnsupportedTests(unittest.TestCase):
+
+    def test_that_older_pythons_raise_runtime_error(self):
+        with self.assertRaises(RuntimeError):
+            sprockets.logging.install_async_json_logging(RecordingHandler())
+        for handler in logging.getLogger().handlers:
+            self.assertNotIsInstance(handler, RecordingHandler)
+
+
+@unittest.skipIf(sys.version_info < (3, 5),
+                 'install_async_json_logging requires Python 3.5')
+class AsyncJSONLoggingTests(unittest.TestCase):
+
+    def setUp(self):
+        super(AsyncJSONLoggingTests, self).setUp()
+        self.recorder = RecordingHandler()
+        self.recorder.setFormatter(sprockets.logging.JSONRequestFormatter())
+        self.listener = sprockets.logging.install_async_json_logging(
+            self.recorder)
+
+    def tearDown(self):
+        super(AsyncJSONLoggingTests, self).tearDown()
+        self.stop_listener()
+
+    def stop_listener(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def test_that_records_are_formatted_by_listener(self):
+        logging.getLogger('test-logger').error('', {'key': 'value'})
+        self.stop_listener()
+        record, line = self.recorder.emitted[0]
+        self.assertEqual(record.args, {'key': 'value'})
+        self.assertEqual(json.loads(line)['request'], {'key': 'value'})
+
+    def test_that_stop_detaches_queue_handler(self):
+        root_logger = logging.getLogger()
+        handler_count = len(root_logger.handlers)
+        self.stop_listener()
+        self.assertEqual(len(root_logger.handlers), handler_count - 1)
+        for handler in root_logger.handlers:
+            self.assertNotIsInstance(handler, logging.handlers.QueueHandler)
+
+    def test_that_exceptions_are_formatted_by_listener(self):
+        try:
+            raise RuntimeError('failure')
+        except RuntimeError:
+            logging.getLogger('test-logger').exception('failed')
+        self.stop_listener()
+        _, line = self.recorder.emitted[0]
+        self.assertEqual(json.loads(line)['traceback']['type'],
+                         'RuntimeError')
+
+
 class ContextFilterTests(TornadoLoggingTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -189,3 +455,29 @@ class ContextFilterTests(TornadoLoggingTestMixin, unittest.TestCase):
         logger.error('error message')
         _, line = self.recorder.emitted[0]
         self.assertEqual(line, 'error message {CID %s}' % cid)
+
+    def test_that_properties_can_be_replaced(self):
+        context_filter = self.recorder.filters[0]
+        context_filter.properties = ['correlation_id', 'other']
+        self.assertEqual(context_filter.properties,
+                         ('correlation_id', 'other'))
+        self.logger.error('error message')
+        record, _ = self.recorder.emitted[0]
+        self.assertIsNone(record.other)
+
+    def test_that_default_values_can_be_specified(self):
+        self.recorder.filters[0].properties = {'correlation_id': '-'}
+        self.logger.error('error message')
+        _, line = self.recorder.emitted[0]
+        self.assertEqual(line, 'error message {CID -}')
+
+    def test_that_duplicate_properties_are_collapsed(self):
+        context_filter = sprockets.logging.ContextFilter(
+            properties=['correlation_id', 'correlation_id'])
+        self.assertEqual(context_filter.properties, ('correlation_id',))
+
+    def test_that_property_order_is_preserved(self):
+        names = tuple('property_{0}'.format(i) for i in range(20))
+        context_filter = sprockets.logging.ContextFilter(
+            properties=names + names[:5])
+        self.assertEqual(context_filter.properties, names)